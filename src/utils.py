@@ -8,8 +8,9 @@ from collections import OrderedDict
 from pathlib import Path
 
 import numpy as np
+from datasets import Dataset, DatasetDict, Features, Value
+from joblib import Parallel, delayed
 from scipy import sparse
-from sklearn.utils import shuffle
 from tqdm import tqdm
 
 from src.csdata import CSData
@@ -76,16 +77,23 @@ def generate_sentences(adata, prefix_len=None, random_state=42):
         )
 
     mat = sparse.csr_matrix(adata.X)
-    sentences = []
-    for i in tqdm(range(mat.shape[0])):
-        cols = mat.indices[mat.indptr[i] : mat.indptr[i + 1]]
-        vals = mat.data[mat.indptr[i] : mat.indptr[i + 1]]
 
-        cols, vals = shuffle(cols, vals)
+    # drop explicitly stored zeros, so that only genes with non-zero expression
+    # are sorted and none of them end up in a sentence
+    row_ids = np.repeat(np.arange(mat.shape[0]), np.diff(mat.indptr))
+    nonzero = mat.data != 0
+    row_ids, indices, vals = row_ids[nonzero], mat.indices[nonzero], mat.data[nonzero]
+    row_ptr = np.searchsorted(row_ids, np.arange(mat.shape[0] + 1))
 
-        sentences.append(
-            "".join([chr(x) for x in cols[np.argsort(-vals, kind="stable")]])
-        )
+    # sort all remaining entries at once by cell, then by decreasing expression,
+    # with ties within a cell split at random
+    order = np.lexsort((np.random.random(len(vals)), -vals, row_ids))
+    sorted_cols = indices[order]
+
+    sentences = []
+    for i in tqdm(range(mat.shape[0])):
+        cols = sorted_cols[row_ptr[i] : row_ptr[i + 1]]
+        sentences.append("".join(map(chr, cols.tolist())))
 
     if prefix_len is not None:
         sentences = [s[:prefix_len] for s in sentences]
@@ -206,3 +214,77 @@ def xlm_prepare_outpath(csdata, outpath, species_tag, params=None):
     with open(fn, "w") as f:
         for l in tqdm(csdata.cell_names[val]):
             print(l, file=f)
+
+
+def _generate_examples(sentences, cell_types=None):
+    """
+    Yield dataset examples for the given cell sentences, along with their cell
+    type labels if provided.
+    """
+    for i, sentence in enumerate(sentences):
+        example = {"input_ids": sentence}
+        if cell_types is not None:
+            example["cell_type"] = str(cell_types[i])
+        yield example
+
+
+def _split_to_arrow(sentences, cell_types, features):
+    """
+    Encode a single data split to an arrow-backed dataset.
+    """
+    return Dataset.from_generator(
+        _generate_examples,
+        features=features,
+        gen_kwargs={"sentences": sentences, "cell_types": cell_types},
+        writer_batch_size=10_000,
+    )
+
+
+def csdata_to_arrow(csdata, outpath, cell_types=None, params=None):
+    """
+    Write cell sentences to an arrow-formatted dataset compatible with HuggingFace's
+    datasets, with "train", "valid", and "test" splits. Sentences are streamed to
+    the arrow writer in batches, without round-tripping through text files.
+
+    Arguments:
+        csdata: a CSData object from a single species to be written.
+        outpath: directory to save the dataset to.
+        cell_types: an optional array of cell type labels, one for each cell
+                    in `csdata`.
+        params: a parameter object passed to train_test_validation_split, use
+                the same value as for `xlm_prepare_outpath` to get matching splits.
+    Return:
+        None
+    """
+
+    if params is None:
+        params = {}
+
+    sentence_strings = csdata.create_sentence_strings(delimiter=" ")
+    train, test, val = csdata.train_test_validation_split(**params)
+
+    features = {"input_ids": Value("string")}
+    if cell_types is not None:
+        cell_types = np.asarray(cell_types)
+        features["cell_type"] = Value("string")
+
+    # each split is encoded independently, so the three are written in parallel
+    data_splits = [("train", train), ("valid", val), ("test", test)]
+    print("INFO: Writing Arrow Datasets", file=sys.stderr)
+    split_datasets = Parallel(n_jobs=len(data_splits), backend="loky")(
+        delayed(_split_to_arrow)(
+            sentence_strings[split_indices],
+            cell_types[split_indices] if cell_types is not None else None,
+            Features(features),
+        )
+        for _, split_indices in data_splits
+    )
+    dataset = DatasetDict(
+        {
+            data_split: split_dataset
+            for (data_split, _), split_dataset in zip(data_splits, split_datasets)
+        }
+    )
+
+    # save each split as several shards, written by parallel processes
+    dataset.save_to_disk(outpath, num_proc=os.cpu_count())
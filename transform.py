@@ -7,49 +7,139 @@ import numpy as np
 import pandas as pd
 import plotnine as pn
 import scanpy as sc
-import sklearn.linear_model as lm
-from datasets import Dataset, load_dataset, concatenate_datasets
-from scipy.stats import pearsonr, spearmanr
-from sklearn.metrics import r2_score
-from sklearn.utils import shuffle
-from tqdm import tqdm
+from numba import njit, prange
+from scipy import sparse, stats
 
 from src import utils
 
 ROW_SUM = 10000
 
 
-def normalize_and_rank_transform(data_matrix_X, normalize=True):
+@njit(parallel=True)
+def _rank_csr_rows(indptr, data, tiebreak, ranks):
     """
-    Helper function which accepts a data matrix, optionally row-normalizes it,
+    Rank the stored entries of each row of a CSR matrix by decreasing value, in
+    parallel over rows. Ties are split by the order of the `tiebreak` keys.
+
+    Ranks are written to `ranks`, an integer array aligned with `data`.
+    """
+    for i in prange(indptr.shape[0] - 1):
+        start, end = indptr[i], indptr[i + 1]
+        shuffled = np.argsort(tiebreak[start:end])
+        order = shuffled[np.argsort(-data[start:end][shuffled], kind="mergesort")]
+        for k in range(end - start):
+            ranks[start + order[k]] = k
+
+
+def normalize_and_rank_transform(
+    data_matrix_X, normalize=True, random_state=utils.SEED
+):
+    """
+    Helper function which accepts a sparse data matrix, optionally row-normalizes it,
     and calculated a rank transformation of the data.
 
+    Only the stored (non-zero) entries of each cell are ranked, since zero-expression
+    genes are all tied and are discarded downstream anyway.
+
     Args:
-        data_matrix_X:  numpy matrix of shape [num_cells, num_genes]
+        data_matrix_X:  scipy.sparse CSR matrix of shape [num_cells, num_genes]
         normalize:      boolean flag for whether to normalize data
+        random_state:   seed for the random generator used to split ties
 
     Returns:
-        data_matrix_X:  normalized data matrix
-        rank_matrix_X:  matrix of rank values for each cell, shame shape as data_matrix_X
+        data_matrix_X:  normalized data matrix, in CSR format
+        rank_matrix_X:  COO matrix of rank values for each cell, with one entry for
+                        each stored entry of data_matrix_X, in the same order
     """
+    data_matrix_X = sparse.csr_matrix(data_matrix_X)
+    data_matrix_X.sort_indices()
     if normalize:
-        normalized_data_matrix_X = (
-            np.diag(ROW_SUM / np.ravel(np.sum(data_matrix_X, axis=1))) @ data_matrix_X
+        # scale the stored values of each row in place of a diagonal matrix product,
+        # which keeps the sparsity structure of the input unchanged
+        row_scale = ROW_SUM / np.ravel(data_matrix_X.sum(axis=1))
+        data_matrix_X.data = data_matrix_X.data * np.repeat(
+            row_scale, np.diff(data_matrix_X.indptr)
         )
-        data_matrix_X = np.asarray(normalized_data_matrix_X)
 
-    rank_matrix_X = np.zeros(shape=data_matrix_X.shape)
-    for i in tqdm(range(data_matrix_X.shape[0])):
-        cols = np.ravel(range(data_matrix_X.shape[1]))
-        vals = np.ravel(data_matrix_X[i, :])
-        cols, vals = shuffle(cols, vals)
-        ranks = cols[np.argsort(-vals, kind="stable")]
-        for j in range(len(ranks)):
-            rank_matrix_X[i, ranks[j]] = j
+    # rank the non-zero entries of each cell, with ties broken at random. Ranks are
+    # below num_genes, so a 16-bit integer type suffices for most datasets
+    rank_dtype = np.uint16 if data_matrix_X.shape[1] <= 65536 else np.int32
+    ranks = np.empty(shape=data_matrix_X.nnz, dtype=rank_dtype)
+    rng = np.random.default_rng(random_state)
+    _rank_csr_rows(
+        data_matrix_X.indptr,
+        data_matrix_X.data,
+        rng.random(data_matrix_X.nnz),
+        ranks,
+    )
+
+    # emit the ranks as (cell, gene, rank) triples in the order of the stored entries
+    rows = np.repeat(
+        np.arange(data_matrix_X.shape[0], dtype=np.int32),
+        np.diff(data_matrix_X.indptr),
+    )
+    cols = data_matrix_X.indices.astype(np.int32, copy=False)
+    rank_matrix_X = sparse.coo_matrix((ranks, (rows, cols)), shape=data_matrix_X.shape)
 
     return data_matrix_X, rank_matrix_X
 
 
+def _sufficient_statistics(a, b):
+    """
+    Sums over a pair of arrays from which their means, variances and covariance
+    can all be derived.
+    """
+    return a.sum(), b.sum(), a @ a, b @ b, a @ b
+
+
+def _pearson_r(n, sum_a, sum_b, sum_aa, sum_bb, sum_ab):
+    """
+    Pearson correlation coefficient and its two-sided p-value, computed from the
+    sufficient statistics of two arrays of length n.
+    """
+    cov_ab = sum_ab - sum_a * sum_b / n
+    var_a = sum_aa - sum_a * sum_a / n
+    var_b = sum_bb - sum_b * sum_b / n
+    r = np.clip(cov_ab / np.sqrt(var_a * var_b), -1.0, 1.0)
+    with np.errstate(divide="ignore"):
+        t = r * np.sqrt((n - 2) / (1 - r * r))
+    p_value = 2 * stats.t.sf(np.abs(t), n - 2)
+    return r.item(), p_value.item()
+
+
+def _fused_metrics(y_true, y_pred):
+    """
+    Compute the R^2 score, Pearson R and Spearman R of predictions against ground
+    truth values. All three metrics are derived from one set of sums over the
+    data, with a single ranking of each array for Spearman R.
+
+    Returns:
+        r_squared, pearson_r, pearson_p_value, spearman_r, spearman_p_value
+    """
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    n = y_true.size
+
+    sum_t, sum_p, sum_tt, sum_pp, sum_tp = _sufficient_statistics(y_true, y_pred)
+    ss_res = sum_tt - 2 * sum_tp + sum_pp
+    ss_tot = sum_tt - sum_t * sum_t / n
+    r_squared = 1 - ss_res / ss_tot
+    pearson_r, pearson_p_value = _pearson_r(n, sum_t, sum_p, sum_tt, sum_pp, sum_tp)
+
+    rank_statistics = _sufficient_statistics(
+        stats.rankdata(y_true), stats.rankdata(y_pred)
+    )
+    spearman_r, spearman_p_value = _pearson_r(n, *rank_statistics)
+
+    return (
+        r_squared.item(),
+        pearson_r,
+        pearson_p_value,
+        spearman_r,
+        spearman_p_value,
+    )
+
+
 def evaluate_transformation(df, plotting_sample_size=10000):
     """
     Helper function which takes as input a pandas DataFrame of expression values and
@@ -70,23 +160,36 @@ def evaluate_transformation(df, plotting_sample_size=10000):
     eval_output_dir = utils.DATA_DIR / "eval"
     eval_output_dir.mkdir(exist_ok=True, parents=True)
 
+    # draw the entries used for plotting once, rather than sampling the full
+    # dataframe for each plot
+    rng = np.random.default_rng(utils.SEED)
+    plotting_sample_ix = rng.choice(
+        len(df), size=min(plotting_sample_size, len(df)), replace=False
+    )
+    plotting_df = df.iloc[plotting_sample_ix]
+
     # (1) Fit linear regression between log rank (x-axis) and log expression (y-axis)
     x_axis_name = "log_preprocessed_rank"
     y_axis_name = "log_preprocessed_transcript_count"
-    x = np.array(df.loc[df[x_axis_name] < utils.BASE10_THRESHOLD, x_axis_name]).reshape(
-        -1, 1
-    )
-    y = df.loc[df[x_axis_name] < utils.BASE10_THRESHOLD, y_axis_name]
-
-    reg = lm.LinearRegression().fit(x, y)
+    # read both columns once as float32, and reuse them for fitting and evaluation
+    x_all = df[x_axis_name].to_numpy(dtype=np.float32, copy=False)
+    y_all = df[y_axis_name].to_numpy(dtype=np.float32, copy=False)
+    fit_mask = x_all < utils.BASE10_THRESHOLD
+
+    # closed-form least squares fit of the single feature, kept in float32
+    x_fit, y_fit = x_all[fit_mask], y_all[fit_mask]
+    x_mean, y_mean = x_fit.mean(), y_fit.mean()
+    x_centered = x_fit - x_mean
+    slope = (x_centered * (y_fit - y_mean)).sum() / (x_centered * x_centered).sum()
+    intercept = y_mean - slope * x_mean
 
     # Plot relationship
     plot = (
         pn.ggplot(
-            df.sample(plotting_sample_size),
+            plotting_df,
             pn.aes(x="log_preprocessed_rank", y="log_preprocessed_transcript_count"),
         )
-        + pn.geom_abline(slope=reg.coef_, intercept=reg.intercept_, color="red")
+        + pn.geom_abline(slope=slope, intercept=intercept, color="red")
         + pn.geom_point(color="blue", size=0.5)
         + pn.labs(
             x="Gene Log Rank",
@@ -97,32 +200,27 @@ def evaluate_transformation(df, plotting_sample_size=10000):
     plot.save(os.path.join(eval_output_dir, "plot_log_rank_vs_log_expr.png"), dpi=300)
 
     # (2) Reconstruct expression from log rank, calculate reconstruction performance metrics
-    rank_reconstructed_X = reg.predict(
-        np.array(df["log_preprocessed_rank"]).reshape(-1, 1)
-    )
+    rank_reconstructed_X = slope * x_all + intercept
 
-    r_squared_score = r2_score(
-        np.asarray(df["log_preprocessed_transcript_count"]),
-        np.asarray(rank_reconstructed_X),
-    )
-    pearson_r_score = pearsonr(
-        np.asarray(df["log_preprocessed_transcript_count"]),
-        np.asarray(rank_reconstructed_X),
-    )
-    spearman_r_score = spearmanr(
-        np.asarray(df["log_preprocessed_transcript_count"]),
-        np.asarray(rank_reconstructed_X),
-    )
+    (
+        r_squared_score,
+        pearson_r_statistic,
+        pearson_r_p_value,
+        spearman_r_statistic,
+        spearman_r_p_value,
+    ) = _fused_metrics(y_all, rank_reconstructed_X)
 
     reconstructed_expr_values_df = pd.DataFrame(
         {
-            "Ground Truth Expression": df["log_preprocessed_transcript_count"],
-            "Reconstructed Expression from Log Rank": rank_reconstructed_X,
+            "Ground Truth Expression": y_all[plotting_sample_ix],
+            "Reconstructed Expression from Log Rank": rank_reconstructed_X[
+                plotting_sample_ix
+            ],
         }
     )
     plot = (
         pn.ggplot(
-            reconstructed_expr_values_df.sample(plotting_sample_size),
+            reconstructed_expr_values_df,
             pn.aes(
                 x="Ground Truth Expression", y="Reconstructed Expression from Log Rank"
             ),
@@ -146,13 +244,13 @@ def evaluate_transformation(df, plotting_sample_size=10000):
     metrics_df = pd.DataFrame(
         {
             "threshold": [utils.BASE10_THRESHOLD],
-            "slope": [reg.coef_.item()],
-            "intercept": [reg.intercept_.item()],
-            "R^2": [r_squared_score.item()],
-            "Pearson_R_statistic": [pearson_r_score.statistic.item()],
-            "Pearson_R_p_value": [pearson_r_score.pvalue.item()],
-            "Spearman_R_statistic": [spearman_r_score.statistic.item()],
-            "Spearman_R_p_value": [spearman_r_score.pvalue.item()],
+            "slope": [slope.item()],
+            "intercept": [intercept.item()],
+            "R^2": [r_squared_score],
+            "Pearson_R_statistic": [pearson_r_statistic],
+            "Pearson_R_p_value": [pearson_r_p_value],
+            "Spearman_R_statistic": [spearman_r_statistic],
+            "Spearman_R_p_value": [spearman_r_p_value],
         }
     )
     metrics_df.to_csv(
@@ -184,34 +282,48 @@ def main(data_filepath: Path, output_dir: Path):
     sc.pp.filter_genes(adata, min_cells=3)
 
     # annotate the group of mitochondrial genes as 'mt'
-    adata.var["mt"] = adata.var_names.str.startswith("MT-")
-    sc.pp.calculate_qc_metrics(
-        adata, qc_vars=["mt"], percent_top=None, log1p=False, inplace=True
+    mt_mask = np.asarray(adata.var_names.str.startswith("MT-"))
+    adata.var["mt"] = mt_mask
+
+    # compute the per-cell quality control metrics directly on the sparse counts
+    counts_X = sparse.csr_matrix(adata.X)
+    adata.obs["n_genes_by_counts"] = np.ravel((counts_X > 0).sum(axis=1))
+    adata.obs["total_counts"] = np.ravel(counts_X.sum(axis=1))
+    adata.obs["total_counts_mt"] = counts_X @ mt_mask.astype(counts_X.dtype)
+    adata.obs["pct_counts_mt"] = (
+        adata.obs["total_counts_mt"] / adata.obs["total_counts"] * 100
     )
 
-    adata = adata[adata.obs.n_genes_by_counts < 2500, :]
-    adata = adata[adata.obs.pct_counts_mt < 200, :]
+    qc_mask = (adata.obs.n_genes_by_counts < 2500) & (adata.obs.pct_counts_mt < 200)
+    adata = adata[qc_mask.to_numpy(), :]
     print(f"Done filtering cells, remaining data of shape {adata.shape}.")
 
-    raw_X = np.copy(adata.X.toarray())
-    norm_X, rank_norm_X = normalize_and_rank_transform(
-        np.copy(adata.X.todense()), normalize=True
-    )
-    # update adata object with normalized expression
-    adata.X = np.log10(1 + norm_X)
-
-    # create dataframe of ranks and expression values for plotting
+    # keep the counts sparse, explicit zeros are dropped so that only expressed
+    # genes are ranked
+    raw_X = sparse.csr_matrix(adata.X, copy=True)
+    raw_X.eliminate_zeros()
+    raw_X.sort_indices()
+    norm_X, rank_norm_X = normalize_and_rank_transform(raw_X, normalize=True)
+    # update adata object with normalized expression, the log is computed once
+    # in place and reused for the evaluation dataframe below
+    log_norm_X = norm_X.copy()
+    np.log10(1 + log_norm_X.data, out=log_norm_X.data)
+    adata.X = log_norm_X
+
+    # ranks are integers in [0, num_genes), so their log is read from a table
+    log_rank_table = np.log10(1 + np.arange(rank_norm_X.shape[1], dtype=np.float32))
+
+    # create dataframe of ranks and expression values for plotting, using only the
+    # non-zero entries of the cellxgene matrix
     expr_and_rank_df = pd.DataFrame(
         {
-            "raw_transcript_count": np.ravel(raw_X),
-            "preprocessed_transcript_count": np.ravel(norm_X),
-            "preprocessed_rank": np.ravel(rank_norm_X),
-            "log_preprocessed_transcript_count": np.log10(1 + np.ravel(norm_X)),
-            "log_preprocessed_rank": np.log10(1 + np.ravel(rank_norm_X)),
+            "raw_transcript_count": raw_X.data,
+            "preprocessed_transcript_count": norm_X.data,
+            "preprocessed_rank": rank_norm_X.data,
+            "log_preprocessed_transcript_count": log_norm_X.data,
+            "log_preprocessed_rank": log_rank_table[rank_norm_X.data],
         }
     )
-    # remove 0 expression entries in the cellxgene matrix
-    expr_and_rank_df = expr_and_rank_df[expr_and_rank_df["raw_transcript_count"] != 0]
     print(f"Done normalizing data, {len(expr_and_rank_df)} data points remaining.")
 
     # compute metrics for transformation to cells and back
@@ -235,29 +347,9 @@ def main(data_filepath: Path, output_dir: Path):
     # make arrow-formatted dataset compatible with HuggingFace's datasets
     hf_output_dir = output_dir / "cell_sentences_hf"
     hf_output_dir.mkdir(exist_ok=True, parents=True)
-    data_splits = ["train", "valid", "test"]
-    data_files = {
-        data_split: str(txt_output_dir / f"{data_split}_human.txt")
-        for data_split in data_splits
-    }
-    dataset = load_dataset("text", data_files=data_files)
-
     # load cell type labels if available with transcript counts
-    for data_split in data_splits:
-        dataset[data_split] = dataset[data_split].rename_column("text", "input_ids")
-        # retrieve split chunk from preprocessed transcript counts
-        dataset_split_sample_indices = np.load(
-            txt_output_dir / f"{data_split}_partition_indices.npy"
-        )
-        adata_split = adata[dataset_split_sample_indices, :].copy()
-        if "cell_type" in adata_split.obs.columns:
-            cell_type_labels = {"cell_type": adata_split.obs["cell_type"].tolist()}
-            cell_type_dataset = Dataset.from_dict(cell_type_labels)
-            dataset[data_split] = concatenate_datasets(
-                [dataset[data_split], cell_type_dataset], axis=1
-            )
-
-    dataset.save_to_disk(hf_output_dir)
+    cell_types = adata.obs["cell_type"] if "cell_type" in adata.obs.columns else None
+    utils.csdata_to_arrow(csdata, hf_output_dir, cell_types=cell_types)
     print(f"Done transforming data to cell sentences.")
 
 